@@ -3,13 +3,18 @@ Display a gaze marker on the camera/scene video. Demonstrates how to receive fra
 a camera frame, and draw a gaze marker.
 '''
 
-import math
+import queue
 import sys
+import threading
 
 # This example requires the PySide2 library for displaying windows and video. Other such libraries are avaliable, and
 # you are free to use whatever you'd like for your projects.
 from PySide2 import QtCore, QtGui, QtWidgets
 
+# This example uses PyTurboJPEG, a wrapper around the libjpeg-turbo library, to quickly decode the frames of the video
+# stream. libjpeg-turbo must be installed on your system for it to be used, otherwise the slower Qt decoder is used.
+from turbojpeg import TJPF_BGRX, TurboJPEG
+
 import adhawkapi
 import adhawkapi.frontend
 from adhawkapi import MarkerSequenceMode
@@ -17,6 +22,11 @@ from adhawkapi import MarkerSequenceMode
 
 MARKER_SIZE = 20  # Diameter in pixels of the gaze marker
 MARKER_COLOR = (0, 250, 50)  # Colour of the gaze marker
+MAX_FRAMES_IN_FLIGHT = 2  # Number of frames that can be decoding or waiting to be displayed before new ones get dropped
+
+
+def _ignore_response(*_args):
+    ''' Callback shared by the api requests whose responses are not needed '''
 
 
 class Frontend:
@@ -30,6 +40,10 @@ class Frontend:
         # with the given handle_et_data callback as the handler
         self._api.register_stream_handler(adhawkapi.PacketType.EYETRACKING_STREAM, handle_et_data)
 
+        # Event that gets set once the frontend is connected. It is created before starting the api, since the
+        # connection callback may run as soon as the api starts.
+        self._connected_event = threading.Event()
+
         # Start the api and set its connection callback to self._handle_connect. When the api detects a connection to a
         # tracker, this function will be run.
         self._api.start(connect_cb=self._handle_connect_response)
@@ -37,20 +51,26 @@ class Frontend:
         # Stores the video receiver's address
         self._video_receiver_address = video_receiver_address
 
-        # Flags the frontend as not connected yet
-        self.connected = False
+    @property
+    def connected(self):
+        ''' Whether the frontend is connected to a tracker '''
+        return self._connected_event.is_set()
+
+    def wait_for_connection(self, timeout=None):
+        ''' Blocks until the frontend is connected or the timeout expires. Returns whether it is connected. '''
+        return self._connected_event.wait(timeout)
 
     def shutdown(self):
         ''' Shuts down the backend connection '''
 
         # Stops the video stream
-        self._api.stop_video_stream(*self._video_receiver_address, lambda *_args: None)
+        self._api.stop_video_stream(*self._video_receiver_address, _ignore_response)
 
         # Stops api camera capture
-        self._api.stop_camera_capture(lambda *_args: None)
+        self._api.stop_camera_capture(_ignore_response)
 
         # Stop the log session
-        self._api.stop_log_session(lambda *_args: None)
+        self._api.stop_log_session(_ignore_response)
 
         # Shuts down the api
         self._api.shutdown()
@@ -60,7 +80,7 @@ class Frontend:
 
         # The tracker's camera will need to be running to detect the marker that the Quick Start procedure will display
         self._api.quick_start_gui(mode=MarkerSequenceMode.FIXED_GAZE, marker_size_mm=35,
-                                  callback=(lambda *_args: None))
+                                  callback=_ignore_response)
 
     def calibrate(self):
         ''' Runs a Calibration using AdHawk Backend's GUI '''
@@ -69,7 +89,7 @@ class Frontend:
         # With fixed head mode you look at calibration markers without moving your head
         # With fixed gaze mode you keep looking at a central point and move your head as instructed during calibration.
         self._api.start_calibration_gui(mode=MarkerSequenceMode.FIXED_HEAD, n_points=9, marker_size_mm=35,
-                                        randomize=False, callback=(lambda *_args: None))
+                                        randomize=False, callback=_ignore_response)
 
     def _handle_connect_response(self, error):
 
@@ -77,11 +97,11 @@ class Frontend:
         if not error:
 
             # Sets the data stream rate to 125Hz
-            self._api.set_et_stream_rate(125, callback=(lambda *_args: None))
+            self._api.set_et_stream_rate(125, callback=_ignore_response)
 
             # Enable the GAZE_IN_IMAGE data stream
             self._api.set_et_stream_control(adhawkapi.EyeTrackingStreamTypes.GAZE_IN_IMAGE, 1,
-                                            callback=(lambda *_args: None))
+                                            callback=_ignore_response)
 
             # Starts the tracker's camera so that video can be captured and sets self._handle_camera_start_response as
             # the callback. This function will be called once the api has finished starting the camera.
@@ -89,10 +109,10 @@ class Frontend:
                                            callback=self._handle_camera_start_response)
 
             # Starts a logging session which saves eye tracking signals. This can be very useful for troubleshooting
-            self._api.start_log_session(log_mode=adhawkapi.LogMode.OCULAR, callback=lambda *args: None)
+            self._api.start_log_session(log_mode=adhawkapi.LogMode.OCULAR, callback=_ignore_response)
 
             # Flags the frontend as connected
-            self.connected = True
+            self._connected_event.set()
 
     def _handle_camera_start_response(self, error):
 
@@ -104,11 +124,48 @@ class Frontend:
             sys.exit()
         else:
             # Otherwise, starts the video stream, streaming to the address of the video receiver
-            self._api.start_video_stream(*self._video_receiver_address, lambda *_args: None)
+            self._api.start_video_stream(*self._video_receiver_address, _ignore_response)
+
+
+class DecodeJob(QtCore.QRunnable):
+    ''' Decodes a frame of the video stream on a worker thread '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, jpeg_decoder, image_buf, frame_buffer, free_frame_buffers, frame_decoded):
+        super().__init__()
+        self._jpeg_decoder = jpeg_decoder
+        self._image_buf = image_buf
+        self._frame_buffer = frame_buffer
+        self._free_frame_buffers = free_frame_buffers
+        self._frame_decoded = frame_decoded
+
+    def run(self):
+        '''
+        Decodes the frame's data into a BGRX buffer and emits it. Without a libjpeg-turbo decoder, the frame is decoded
+        into a Qt image instead.
+        '''
+        try:
+            if self._jpeg_decoder is None:
+                frame = QtGui.QImage.fromData(self._image_buf, 'JPG')
+                if frame.isNull():
+                    raise OSError('Qt could not decode the JPEG data')
+            else:
+                frame = self._jpeg_decoder.decode(self._image_buf, pixel_format=TJPF_BGRX, dst=self._frame_buffer)
+        except OSError as err:
+            # Drops a corrupt or truncated frame, and returns its buffer to the pool so that later frames still decode
+            print(f'Dropped a frame that could not be decoded: {err}')
+            self._free_frame_buffers.put(self._frame_buffer)
+            return
+        self._frame_decoded.emit(frame)
 
 
 class GazeViewer(QtWidgets.QWidget):
     ''' Class for receiving and displaying the video stream '''
+    # pylint: disable=too-many-instance-attributes
+
+    # Signals used to hand decoded frames and gaze coordinates over to the GUI thread
+    frame_decoded = QtCore.Signal(object)
+    gaze_in_image_received = QtCore.Signal(float, float)
 
     def __init__(self):
         QtWidgets.QWidget.__init__(self)
@@ -118,13 +175,20 @@ class GazeViewer(QtWidgets.QWidget):
         self.text_label.setAlignment(QtCore.Qt.AlignCenter)
 
         # Qt code to create a label that can hold an image. We will use this label to hold successive images from the
-        # video stream.
+        # video stream. The images are aligned to the label's top left corner, so that image coordinates match the
+        # label's coordinates.
         self.image_label = QtWidgets.QLabel(self)
+        self.image_label.setAlignment(QtCore.Qt.AlignLeft | QtCore.Qt.AlignTop)
         vbox = QtWidgets.QVBoxLayout()
         vbox.addWidget(self.text_label)
         vbox.addWidget(self.image_label)
         self.setLayout(vbox)
 
+        # The gaze marker is drawn only once, into a label placed on top of the video. Rather than drawing the marker on
+        # every frame, the label is moved to the gaze position whenever new gaze data arrives.
+        self._gaze_marker = self._create_gaze_marker()
+        self.gaze_in_image_received.connect(self._move_gaze_marker)
+
         # A Quick Start tunes the scan range and frequency to best suit the user's eye and face shape, resulting in
         # better tracking data. For the best quality results in your application, you should also perform a calibration
         # before using gaze data.
@@ -136,6 +200,27 @@ class GazeViewer(QtWidgets.QWidget):
         self.calibration_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('c'), self)
         self.calibration_shortcut.activated.connect(self.calibrate)
 
+        # Frames are decoded on a worker thread so that the GUI thread is only used to display them. A single thread is
+        # used so that the frames are decoded in order. If the libjpeg-turbo library can't be loaded, the frames are
+        # decoded by Qt instead.
+        try:
+            self._jpeg_decoder = TurboJPEG()
+        except (OSError, RuntimeError) as err:
+            print(f'Could not load libjpeg-turbo ({err}), decoding video frames with Qt instead')
+            self._jpeg_decoder = None
+        self._decode_pool = QtCore.QThreadPool(self)
+        self._decode_pool.setMaxThreadCount(1)
+        self.frame_decoded.connect(self._handle_decoded_frame)
+
+        # Pool of buffers the frames get decoded into. A buffer is reused from one frame to the next as long as the
+        # frame size doesn't change. When no buffer is free, new frames are dropped rather than left to pile up. The
+        # displayed frame's buffer is kept out of the pool until a new frame replaces it, since the label is still
+        # painting from it, so one buffer more than MAX_FRAMES_IN_FLIGHT is used.
+        self._free_frame_buffers = queue.SimpleQueue()
+        for _ in range(MAX_FRAMES_IN_FLIGHT):
+            self._free_frame_buffers.put(None)
+        self._displayed_frame = None
+
         # Instantiate and start a video receiver with self._handle_video_stream as the handler for new frames
         self._video_receiver = adhawkapi.frontend.VideoReceiver()
         self._video_receiver.frame_received_event.add_callback(self._handle_video_stream)
@@ -145,9 +230,6 @@ class GazeViewer(QtWidgets.QWidget):
         # be sent to it.
         self.frontend = Frontend(self._handle_et_data, self._video_receiver.address)
 
-        # Initialize the gaze coordinates to dummy values for now
-        self._gaze_coordinates = (0, 0)
-
     def closeEvent(self, event):
         '''
         Override of the window's close event. When the window closes, we want to ensure that we shut down the api
@@ -162,6 +244,10 @@ class GazeViewer(QtWidgets.QWidget):
         ''' Property to allow the main loop to check whether the api is connected to a tracker '''
         return self.frontend.connected
 
+    def wait_for_connection(self, timeout=None):
+        ''' Function to allow the main loop to wait for the api to connect to a tracker '''
+        return self.frontend.wait_for_connection(timeout)
+
     def quickstart(self):
         ''' Function to allow the main loop to invoke a Quick Start '''
         self.frontend.quickstart()
@@ -170,45 +256,76 @@ class GazeViewer(QtWidgets.QWidget):
         ''' Function to allow the main loop to invoke a Calibration '''
         self.frontend.calibrate()
 
-    def _handle_video_stream(self, _gaze_imestamp, image_buf, _frame_timestamp):
+    def _create_gaze_marker(self):
+        ''' Draws the gaze marker into a hidden Qt Label placed on top of the video '''
+        gaze_marker_pixmap = QtGui.QPixmap(MARKER_SIZE, MARKER_SIZE)
+        gaze_marker_pixmap.fill(QtCore.Qt.transparent)
+        painter = QtGui.QPainter(gaze_marker_pixmap)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setBrush(QtGui.QBrush(QtGui.QColor(*MARKER_COLOR), QtCore.Qt.SolidPattern))
+        painter.drawEllipse(QtCore.QRect(0, 0, MARKER_SIZE, MARKER_SIZE))
+        painter.end()
 
-        # Create a new Qt pixmap and load the frame's data into it
-        qt_img = QtGui.QPixmap()
-        qt_img.loadFromData(image_buf, 'JPEG')
+        gaze_marker = QtWidgets.QLabel(self.image_label)
+        gaze_marker.setPixmap(gaze_marker_pixmap)
+        gaze_marker.resize(MARKER_SIZE, MARKER_SIZE)
+        gaze_marker.hide()
+        return gaze_marker
 
-        # Get the image's size. If self._frame_size has not yet been initialized, we set its values to the frame size.
-        size = qt_img.size().toTuple()
-        if size[0] != self.image_label.width() or size[1] != self.image_label.height():
+    def _handle_video_stream(self, _gaze_imestamp, image_buf, _frame_timestamp):
 
-            # Set the image label's size to the frame's size
-            self.image_label.resize(size[0], size[1])
+        # Drops the frame if too many frames are already being decoded or waiting to be displayed
+        try:
+            frame_buffer = self._free_frame_buffers.get_nowait()
+        except queue.Empty:
+            return
 
-        # Draws the gaze marker on the new frame
-        self._draw_gaze_marker(qt_img)
+        # Decodes the frame on the decode thread. The decoded frame is handed to self._handle_decoded_frame.
+        self._decode_pool.start(DecodeJob(self._jpeg_decoder, image_buf, frame_buffer, self._free_frame_buffers,
+                                          self.frame_decoded))
 
-        # Sets the new image
-        self.image_label.setPixmap(qt_img)
+    def _handle_decoded_frame(self, frame):
+        if isinstance(frame, QtGui.QImage):
+            # Frames decoded by Qt own their data, so there is no frame buffer to hold on to
+            qt_img = frame
+            frame = None
+        else:
+            # Wrap the frame in a Qt image without copying it. On little-endian machines, the bytes of Qt's RGB32 format
+            # are laid out in BGRX order.
+            qt_img = QtGui.QImage(frame.data, frame.shape[1], frame.shape[0], frame.shape[1] * 4,
+                                  QtGui.QImage.Format_RGB32)
+        width = qt_img.width()
+        height = qt_img.height()
+
+        # If the frame size has changed, we set the image label's size to the frame's size
+        if width != self.image_label.width() or height != self.image_label.height():
+            self.image_label.resize(width, height)
+
+        # Sets the new image. The Qt image is already in the pixmap's format, so the pixmap shares the frame's buffer
+        # rather than copying it. The buffer can only be reused once a new frame replaces this one, so it is the
+        # previously displayed frame's buffer that goes back to the pool.
+        self.image_label.setPixmap(QtGui.QPixmap.fromImage(qt_img))
+        previous_frame, self._displayed_frame = self._displayed_frame, frame
+        self._free_frame_buffers.put(previous_frame)
 
     def _handle_et_data(self, et_data):
 
-        # Updates the gaze marker coordinates with new gaze data. It is possible to receive NaN from the api, so we
-        # filter the input accordingly.
+        # Hands new gaze data over to the GUI thread, which moves the gaze marker
         if et_data.gaze_in_image is not None:
             gaze_img_x, gaze_img_y, *_ = et_data.gaze_in_image
-            self._gaze_coordinates = [gaze_img_x, gaze_img_y]
+            self.gaze_in_image_received.emit(gaze_img_x, gaze_img_y)
+
+    def _move_gaze_marker(self, gaze_img_x, gaze_img_y):
 
-    def _draw_gaze_marker(self, qt_img):
-        if math.isnan(self._gaze_coordinates[0]) or math.isnan(self._gaze_coordinates[1]):
+        # It is possible to receive NaN from the api, in which case we hide the gaze marker. NaN is the only value that
+        # is not equal to itself (IEEE-754), which makes for a cheaper check than math.isnan.
+        if gaze_img_x != gaze_img_x or gaze_img_y != gaze_img_y:  # pylint: disable=comparison-with-itself
+            self._gaze_marker.hide()
             return
 
-        # Draws the gaze marker on the given frame image
-        painter = QtGui.QPainter(qt_img)
-        painter.setRenderHint(QtGui.QPainter.Antialiasing)
-        painter.setBrush(QtGui.QBrush(QtGui.QColor(*MARKER_COLOR), QtCore.Qt.SolidPattern))
-        painter.drawEllipse(QtCore.QRectF(self._gaze_coordinates[0] - MARKER_SIZE / 2,
-                                          self._gaze_coordinates[1] - MARKER_SIZE / 2,
-                                          MARKER_SIZE, MARKER_SIZE))
-        painter.end()
+        # Moves the gaze marker so that it is centered on the gaze coordinates
+        self._gaze_marker.move(round(gaze_img_x - MARKER_SIZE / 2), round(gaze_img_y - MARKER_SIZE / 2))
+        self._gaze_marker.show()
 
 
 def main():
@@ -217,8 +334,8 @@ def main():
     main_window = GazeViewer()
     try:
         print('Plug in your tracker and ensure AdHawk Backend is running.')
-        while not main_window.connected:
-            pass  # Waits for the frontend to be connected before proceeding
+        while not main_window.wait_for_connection(timeout=0.5):
+            pass  # Waits for the frontend to be connected before proceeding, waking up to handle keyboard interrupts
     except (KeyboardInterrupt, SystemExit):
         main_window.close()
         # Allows the frontend to be shut down robustly on a keyboard interrupt
@@ -3,9 +3,7 @@ Display a gaze marker inside a screen.
 Demonstates how to create a window which displays markers and map gaze data into the given window
 '''
 
-import math
 import sys
-from collections import deque
 
 import cv2
 import cv2.aruco as aruco  # pylint: disable=no-member, import-error
@@ -23,6 +21,10 @@ from adhawkapi.publicapi import Events, MarkerSequenceMode
 GAZE_MARKER_SIZE = 20
 
 
+def _ignore_response(*_args):
+    ''' Callback shared by the api requests whose responses are not needed '''
+
+
 class Frontend:
     '''
     Frontend communicating with the backend
@@ -54,7 +56,7 @@ class Frontend:
         self.enable_screen_tracking(False)
 
         # Stop the log session
-        self._api.stop_log_session(lambda *_args: None)
+        self._api.stop_log_session(_ignore_response)
 
         # Shuts down the api
         self._api.shutdown()
@@ -65,7 +67,7 @@ class Frontend:
 
         # The tracker's camera will need to be running to detect the marker that the Quick Start procedure will display
         self._api.quick_start_gui(mode=MarkerSequenceMode.FIXED_GAZE, marker_size_mm=35,
-                                  callback=(lambda *_args: None))
+                                  callback=_ignore_response)
 
     def calibrate(self):
         ''' Calibrates the gaze tracker using AdHawk Backend's GUI '''
@@ -74,7 +76,7 @@ class Frontend:
         # With fixed head mode you look at calibration markers without moving your head
         # With fixed gaze mode you keep looking at a central point and move your head as instructed during calibration
         self._api.start_calibration_gui(mode=MarkerSequenceMode.FIXED_HEAD, n_points=9, marker_size_mm=35,
-                                        randomize=False, callback=(lambda *_args: None))
+                                        randomize=False, callback=_ignore_response)
 
     def register_screen(self, screen_width, screen_height, aruco_dic, marker_ids, markers):
         ''' Registers the screen and starts tracking on a successful discovery'''
@@ -91,7 +93,7 @@ class Frontend:
         self._api.set_et_stream_control([adhawkapi.EyeTrackingStreamTypes.GAZE,
                                          adhawkapi.EyeTrackingStreamTypes.GAZE_IN_SCREEN],
                                         enable,
-                                        callback=(lambda *_args: None))
+                                        callback=_ignore_response)
 
     def _handle_event_stream(self, event_type, _timestamp, *_args):
         ''' Handler for the event stream '''
@@ -110,13 +112,13 @@ class Frontend:
             print('Backend connected')
 
             # Sets the data stream rate to 125Hz
-            self._api.set_et_stream_rate(125, callback=(lambda *_args: None))
+            self._api.set_et_stream_rate(125, callback=_ignore_response)
 
             # Tells the api which event streams we want to tap into, in this case the PROCEDURE_START_END stream
-            self._api.set_event_control(adhawkapi.EventControlBit.PRODECURE_START_END, 1, callback=(lambda *args: None))
+            self._api.set_event_control(adhawkapi.EventControlBit.PRODECURE_START_END, 1, callback=_ignore_response)
 
             # Starts a logging session which saves eye tracking signals. This can be very useful for troubleshooting
-            self._api.start_log_session(log_mode=adhawkapi.LogMode.OCULAR, callback=lambda *args: None)
+            self._api.start_log_session(log_mode=adhawkapi.LogMode.OCULAR, callback=_ignore_response)
 
             self._register_board()
 
@@ -128,16 +130,40 @@ class Frontend:
             self.enable_screen_tracking(True)
 
 
+class MarkerImageJob(QtCore.QRunnable):
+    ''' Generates the ArUco marker images on a worker thread '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, create_marker_images, marker_images_created):
+        super().__init__()
+        self._create_marker_images = create_marker_images
+        self._marker_images_created = marker_images_created
+
+    def run(self):
+        ''' Generates the marker images, wraps each one in a Qt image and emits them '''
+        marker_images = []
+        for x_offset, y_offset, marker_image in self._create_marker_images():
+            qt_marker_image = QtGui.QImage(marker_image, marker_image.shape[1], marker_image.shape[0],
+                                           marker_image.shape[1], QtGui.QImage.Format_Grayscale8)
+            marker_images.append((x_offset, y_offset, marker_image, qt_marker_image))
+        self._marker_images_created.emit(marker_images)
+
+
 class TrackingWindow(QtWidgets.QWidget):
     ''' Class for receiving and displaying the user's gaze in the screen '''
     # pylint: disable=too-many-instance-attributes
     MARKER_DIC = cv2.aruco.DICT_4X4_50  # pylint: disable=no-member
+    MARKER_DICTIONARY = aruco.getPredefinedDictionary(MARKER_DIC)
     ARUCO_MARKER_SIZE_MM = 20
     ARUCO_MARKER_BORDER_MM = 1
-    EDGE_OFFSETS_MM = np.array([[10, 10], [10, 10]])  # Marker offsets: [[left, right], [top, bottom]]
+    EDGE_OFFSETS_MM = ((10, 10), (10, 10))  # Marker offsets: [[left, right], [top, bottom]]
 
     NUM_POINTS = 10
 
+    # Signals used to process the latest gaze sample and show the generated marker images on the GUI thread
+    gaze_sample_received = QtCore.Signal()
+    marker_images_created = QtCore.Signal(object)
+
     def __init__(self):
         QtWidgets.QWidget.__init__(self)
         self.setWindowTitle('Screen tracking example')
@@ -147,11 +173,11 @@ class TrackingWindow(QtWidgets.QWidget):
         dpi_y = QtWidgets.QApplication.instance().primaryScreen().physicalDotsPerInchY()
 
         # Calculates the 'real' dpi as the average of the horizontal and vertical dpis
-        self._dpi = np.mean([dpi_x, dpi_y])
+        self._dpi = (dpi_x + dpi_y) * 0.5
 
         # Use the entire screen
-        self._screen_size = np.array([QtWidgets.QApplication.instance().primaryScreen().geometry().width(),
-                                      QtWidgets.QApplication.instance().primaryScreen().geometry().height()])
+        self._screen_size = (QtWidgets.QApplication.instance().primaryScreen().geometry().width(),
+                             QtWidgets.QApplication.instance().primaryScreen().geometry().height())
 
         # Gets the screen size in mm and outputs all screen information to the console
         self._screen_size_mm = self._pix_to_mm(self._screen_size)
@@ -163,15 +189,15 @@ class TrackingWindow(QtWidgets.QWidget):
         # Calculate the position of the markers on the screen
         self._marker_positions = self._calculate_marker_positions()
 
-        # Takes the marker positions and generates an RGBA OpenCV image
-        marker_image = self._create_marker_image()
-
-        # Convert the RGBA buffer into a Qt Label widget
-        self._marker_widget = QtWidgets.QLabel()
-        qt_marker_image = QtGui.QImage(marker_image, marker_image.shape[1], marker_image.shape[0],
-                                       marker_image.shape[1] * marker_image.shape[2], QtGui.QImage.Format_ARGB32)
-        self._marker_pixmap = QtGui.QPixmap(qt_marker_image)
-        self._marker_widget.setPixmap(self._marker_pixmap)
+        # Markers layer / widget. Each marker is shown by its own Qt Label, placed at the marker's position. Only the
+        # markers are drawn, so no screen-sized image is needed and the background shows through everywhere else.
+        # The marker images are generated on a worker thread so that the window appears without waiting for them, and
+        # the labels are added once the images are ready.
+        self._marker_widget = QtWidgets.QWidget()
+        self._marker_images = []
+        self.marker_images_created.connect(self._handle_marker_images_created)
+        QtCore.QThreadPool.globalInstance().start(MarkerImageJob(self._create_marker_images,
+                                                                 self.marker_images_created))
 
         # Text instruction layer / widget
         text_label = QtWidgets.QLabel()
@@ -189,89 +215,109 @@ class TrackingWindow(QtWidgets.QWidget):
         layout.addWidget(self._marker_widget, 0, 0)
         layout.addWidget(text_label, 0, 0)
 
-        # A Quick Start tunes the scan range and frequency to best suit the user's eye and face shape, resulting in
-        # better tracking data. For the best quality results in your application, you should also perform a calibration
-        # before using gaze data.
-        self.quickstart_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('q'), self)
-        self.quickstart_shortcut.activated.connect(self._quickstart)
-
-        # A calibration allows us to relate the measured gaze with the real world using a series of markers displayed
-        # in known positions
-        self.calibration_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('c'), self)
-        self.calibration_shortcut.activated.connect(self._calibrate)
-
-        self.calibration_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('Escape'), self)
-        self.calibration_shortcut.activated.connect(self.close)
+        # Gaze marker layer / widget. The gaze marker is drawn only once, and the widget is moved to the gaze position
+        # on every frame, so that the marker image never needs to be redrawn.
+        self._gaze_marker_widget = self._create_gaze_marker_widget()
+
+        # Keyboard shortcuts, and the functions they run:
+        # Q runs a Quick Start, which tunes the scan range and frequency to best suit the user's eye and face shape,
+        # resulting in better tracking data. For the best quality results in your application, you should also perform a
+        # calibration before using gaze data.
+        # C runs a calibration, which allows us to relate the measured gaze with the real world using a series of
+        # markers displayed in known positions.
+        # ESC closes the window.
+        shortcut_handlers = {'q': self._quickstart, 'c': self._calibrate, 'Escape': self.close}
+        self._shortcuts = {}
+        for key, handler in shortcut_handlers.items():
+            self._shortcuts[key] = QtWidgets.QShortcut(QtGui.QKeySequence(key), self)
+            self._shortcuts[key].activated.connect(handler)
 
         self.setWindowFlag(QtCore.Qt.FramelessWindowHint)
         self.showMaximized()
 
-        # Deque for storing the most recent gaze points, which is currently needed to reduce jitter
-        self._point_deque = deque()
+        # Ring buffer for storing the most recent gaze points, which is currently needed to reduce jitter
+        self._point_ring = np.zeros((self.NUM_POINTS, 2), dtype=np.int32)
+        self._point_index = 0
+        self._point_count = 0
 
+        # Running sums of the coordinates of the points in the ring buffer
         self._running_xcoord = 0
         self._running_ycoord = 0
 
         self._xcoord = None
         self._ycoord = None
 
-        # Creates the Frontend object
-        self.frontend = Frontend(self._handle_register_board, self._handle_et_data)
+        # The gaze marker is only moved when new gaze data arrives, and moves are skipped when the marker's position
+        # hasn't changed. Qt merges the repaints of several moves that happen between two display frames.
+        self._last_marker_pos = None
 
-        self._setup_video_timer()
+        # The stream handler only stores the latest gaze sample, which then gets processed on the GUI thread. If the GUI
+        # thread falls behind, samples are replaced by newer ones rather than queued up, which keeps the gaze marker
+        # from lagging behind the user's gaze.
+        self._latest_sample = None
+        self._sample_pending = False
+        self.gaze_sample_received.connect(self._process_gaze_sample, QtCore.Qt.QueuedConnection)
 
-    def _setup_video_timer(self):
-        self._imagetimer_interval = 1000 / 60
-        self._imagetimer = QtCore.QTimer()
-        self._imagetimer.timeout.connect(self._every_frame)
-        self._imagetimer.start(self._imagetimer_interval)
+        # Creates the Frontend object
+        self.frontend = Frontend(self._handle_register_board, self._handle_et_data)
 
     def _handle_et_data(self, et_data):
         ''' Handler for the gaze in screen stream '''
         if et_data.gaze_in_screen is None:
             return
 
-        xpos, ypos = et_data.gaze_in_screen
-        if math.isnan(xpos) or math.isnan(ypos):
+        # Stores the latest sample, and schedules its processing unless that is already pending
+        self._latest_sample = et_data.gaze_in_screen
+        if not self._sample_pending:
+            self._sample_pending = True
+            self.gaze_sample_received.emit()
+
+    def _process_gaze_sample(self):
+        ''' Smooths the latest gaze sample and moves the gaze marker '''
+        self._sample_pending = False
+        sample, self._latest_sample = self._latest_sample, None
+        if sample is None:
             return
 
-        # Translates the passed coordinates to positions on the screen
-        new_xcoord = round(self._screen_size[0] * xpos)
-        new_ycoord = round(self._screen_size[1] * ypos)
-
-        # Adds the new point to the point deque, and pops the least recent entry if the size of the deque exceeds
-        # its maximum allowed size
-        old_xcoord = 0
-        old_ycoord = 0
-        self._point_deque.append((new_xcoord, new_ycoord))
-        if len(self._point_deque) > self.NUM_POINTS:
-            (old_xcoord, old_ycoord) = self._point_deque.popleft()
-
-        # Calculates display coordinates as an average of all points in the deque (reduces jitter)
-        self._running_xcoord += new_xcoord - old_xcoord
-        self._running_ycoord += new_ycoord - old_ycoord
-
-        self._xcoord = self._running_xcoord / len(self._point_deque)
-        self._ycoord = self._running_ycoord / len(self._point_deque)
-
-    def _every_frame(self):
-        if not self._xcoord or not self._ycoord:
+        # Filters out NaN, which is the only value that is not equal to itself (IEEE-754). This is cheaper than calling
+        # math.isnan.
+        xpos, ypos = sample
+        if xpos != xpos or ypos != ypos:  # pylint: disable=comparison-with-itself
             return
 
-        pixmap = self._marker_pixmap.copy()
-
-        # Qt code to draw a circle at the calculated position
-        painter = QtGui.QPainter(pixmap)
-        painter.setRenderHint(QtGui.QPainter.Antialiasing)
-        painter.setBrush(QtGui.QBrush(QtGui.QColor(255, 0, 0), QtCore.Qt.SolidPattern))
-        painter.setPen(QtCore.Qt.NoPen)
-        painter.drawEllipse(QtCore.QRectF(self._xcoord - GAZE_MARKER_SIZE / 2,
-                                          self._ycoord - GAZE_MARKER_SIZE / 2,
-                                          GAZE_MARKER_SIZE, GAZE_MARKER_SIZE))
-        painter.end()
+        # Translates the passed coordinates to positions on the screen, rounded to the nearest pixel
+        new_xcoord = round(self._screen_size[0] * xpos)
+        new_ycoord = round(self._screen_size[1] * ypos)
 
-        # Sets the new image with the gaze marker ellipse drawn
-        self._marker_widget.setPixmap(pixmap)
+        # Overwrites the least recent point in the ring buffer with the new point, and updates the running sums
+        index = self._point_index
+        self._running_xcoord += new_xcoord - self._point_ring.item(index, 0)
+        self._running_ycoord += new_ycoord - self._point_ring.item(index, 1)
+        self._point_ring[index, 0] = new_xcoord
+        self._point_ring[index, 1] = new_ycoord
+        self._point_index = (index + 1) % self.NUM_POINTS
+        self._point_count = min(self._point_count + 1, self.NUM_POINTS)
+
+        # Calculates display coordinates as an average of all points in the ring buffer (reduces jitter)
+        self._xcoord = self._running_xcoord / self._point_count
+        self._ycoord = self._running_ycoord / self._point_count
+
+        # Moves the gaze marker, unless it would not move (which is common while the gaze is fixated)
+        marker_pos = (round(self._xcoord - GAZE_MARKER_SIZE / 2), round(self._ycoord - GAZE_MARKER_SIZE / 2))
+        if marker_pos != self._last_marker_pos:
+            self._last_marker_pos = marker_pos
+            self._gaze_marker_widget.move(*marker_pos)
+            self._gaze_marker_widget.show()
+
+    def _handle_marker_images_created(self, marker_images):
+        ''' Shows the generated marker images, each in its own Qt Label '''
+        # The images are kept as an attribute since the Qt images use their buffers without copying them
+        self._marker_images = marker_images
+        for x_offset, y_offset, marker_image, qt_marker_image in marker_images:
+            marker_label = QtWidgets.QLabel(self._marker_widget)
+            marker_label.setPixmap(QtGui.QPixmap.fromImage(qt_marker_image, QtCore.Qt.NoFormatConversion))
+            marker_label.setGeometry(x_offset, y_offset, marker_image.shape[1], marker_image.shape[0])
+            marker_label.show()
 
     def _handle_register_board(self):
         ''' Handler for the camera start response '''
@@ -280,58 +326,87 @@ class TrackingWindow(QtWidgets.QWidget):
                                       self.MARKER_DIC, self._marker_ids, self._marker_positions)
 
     def _mm_to_pix(self, length_mm):
-        ''' Converts an array of values in mm to an aray of pixel lengths '''
+        ''' Converts a value or a (nested) tuple of values in mm to a pixel length or a tuple of pixel lengths '''
         mm2inch = 25.4
-        return (np.array(length_mm) * self._dpi / mm2inch).astype(int)
+        if isinstance(length_mm, tuple):
+            return tuple(self._mm_to_pix(value) for value in length_mm)
+        return int(length_mm * self._dpi / mm2inch)
 
     def _pix_to_mm(self, length_pix):
-        ''' Converts an array of pixel lengths to an array of values in mm '''
+        ''' Converts a pixel length or a (nested) tuple of pixel lengths to a value or a tuple of values in mm '''
         mm2inch = 25.4
-        return np.array(length_pix) * mm2inch / self._dpi
+        if isinstance(length_pix, tuple):
+            return tuple(self._pix_to_mm(value) for value in length_pix)
+        return length_pix * mm2inch / self._dpi
 
     def _calculate_marker_positions(self):
         ''' Calculates up the positions of the ArUco markers on the screen '''
-        margin_size = self.EDGE_OFFSETS_MM * 1e-3
-        screen_size = self._screen_size_mm * 1e-3
+        (left_mm, right_mm), (top_mm, bottom_mm) = self.EDGE_OFFSETS_MM
+        left, right, top, bottom = left_mm * 1e-3, right_mm * 1e-3, top_mm * 1e-3, bottom_mm * 1e-3
+        screen_width = self._screen_size_mm[0] * 1e-3
+        screen_height = self._screen_size_mm[1] * 1e-3
         marker_size = self.ARUCO_MARKER_SIZE_MM * 1e-3
 
-        positions = np.array([
-            [margin_size[0, 0], - margin_size[1, 0] - marker_size],
-            [screen_size[0] - margin_size[0, 1] - marker_size, - margin_size[1, 0] - marker_size],
-            [margin_size[0, 0], - screen_size[1] + margin_size[1, 1]],
-            [screen_size[0] - margin_size[0, 1] - marker_size, - screen_size[1] + margin_size[1, 1]],
-        ])
-        markers = []
-        for marker_pos in positions:
-            markers.append([*marker_pos, marker_size])
-        return markers
-
-    def _create_marker_image(self):
-        ''' Uses the calculated marker positions to draw ArUco markers to an image '''
+        # There are only four markers, so their positions are computed with plain Python math. If many more markers
+        # were used, this would be a good candidate for a loop compiled with numba's @njit(cache=True).
+        return [
+            [left, -top - marker_size, marker_size],
+            [screen_width - right - marker_size, -top - marker_size, marker_size],
+            [left, -screen_height + bottom, marker_size],
+            [screen_width - right - marker_size, -screen_height + bottom, marker_size],
+        ]
+
+    def _create_marker_images(self):
+        '''
+        Uses the calculated marker positions to draw each ArUco marker, surrounded by a white border, to a grayscale
+        image. Returns the (x, y) position of each image on the screen, and the image itself.
+        '''
 
         marker_size = int(self._screen_size[0] * self.ARUCO_MARKER_SIZE_MM / self._screen_size_mm[0])
         margins = self._mm_to_pix(self.EDGE_OFFSETS_MM)
-        board_image = np.zeros((self._screen_size[1], self._screen_size[0], 4), dtype=np.uint8)
-
-        offsets = {0: (margins[0, 0], margins[1, 0]),
-                   1: (self._screen_size[0] - margins[0, 1] - marker_size, margins[1, 0]),
-                   2: (margins[0, 0], self._screen_size[1] - margins[1, 1] - marker_size),
-                   3: (self._screen_size[0] - margins[0, 1] - marker_size,
-                       self._screen_size[1] - margins[1, 1] - marker_size)}
-
-        for _id_i, _id in enumerate(self._marker_ids):
-            _img = np.full((marker_size, marker_size), 255, dtype=np.uint8)
-            aruco.drawMarker(aruco.Dictionary_get(self.MARKER_DIC), _id, marker_size, _img, 1)
-            _img = cv2.cvtColor(_img, cv2.COLOR_GRAY2RGBA)
-            board_image[offsets[_id_i][1]:offsets[_id_i][1] + marker_size,
-                        offsets[_id_i][0]:offsets[_id_i][0] + marker_size] = _img
-
-            border_thickness = self._mm_to_pix(self.ARUCO_MARKER_BORDER_MM)
-            border_start = (offsets[_id_i][0] - border_thickness, offsets[_id_i][1] - border_thickness)
-            border_end = (offsets[_id_i][0] + marker_size, offsets[_id_i][1] + marker_size)
-            board_image = cv2.rectangle(board_image, border_start, border_end, (255, 255, 255, 255), border_thickness)
-
-        return board_image
+
+        # Top left corner of each marker, indexed by the marker's position in self._marker_ids
+        offsets = np.array([[margins[0][0], margins[1][0]],
+                            [self._screen_size[0] - margins[0][1] - marker_size, margins[1][0]],
+                            [margins[0][0], self._screen_size[1] - margins[1][1] - marker_size],
+                            [self._screen_size[0] - margins[0][1] - marker_size,
+                             self._screen_size[1] - margins[1][1] - marker_size]], dtype=np.int32)
+
+        border_thickness = self._mm_to_pix(self.ARUCO_MARKER_BORDER_MM)
+        image_size = marker_size + 2 * border_thickness
+
+        # Generates each distinct marker only once
+        markers = {_id: aruco.generateImageMarker(self.MARKER_DICTIONARY, _id, marker_size)
+                   for _id in set(self._marker_ids)}
+
+        marker_images = []
+        for (x_offset, y_offset), _id in zip(offsets - border_thickness, self._marker_ids):
+            # Fills the image with white for the border, then copies the marker in
+            marker_image = np.full((image_size, image_size), 255, dtype=np.uint8)
+            np.copyto(marker_image[border_thickness:border_thickness + marker_size,
+                                   border_thickness:border_thickness + marker_size], markers[_id])
+            marker_images.append((int(x_offset), int(y_offset), marker_image))
+
+        return marker_images
+
+    def _create_gaze_marker_widget(self):
+        ''' Draws the gaze marker into a hidden Qt Label placed on top of the window's other widgets '''
+        gaze_marker_pixmap = QtGui.QPixmap(GAZE_MARKER_SIZE, GAZE_MARKER_SIZE)
+        gaze_marker_pixmap.fill(QtCore.Qt.transparent)
+        painter = QtGui.QPainter(gaze_marker_pixmap)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setBrush(QtGui.QBrush(QtGui.QColor(255, 0, 0), QtCore.Qt.SolidPattern))
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.drawEllipse(QtCore.QRect(0, 0, GAZE_MARKER_SIZE, GAZE_MARKER_SIZE))
+        painter.end()
+
+        gaze_marker_widget = QtWidgets.QLabel(self)
+        gaze_marker_widget.setPixmap(gaze_marker_pixmap)
+        gaze_marker_widget.resize(GAZE_MARKER_SIZE, GAZE_MARKER_SIZE)
+        gaze_marker_widget.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        gaze_marker_widget.hide()
+        gaze_marker_widget.raise_()
+        return gaze_marker_widget
 
     def _calibrate(self):
         ''' Function to allow the main loop to invoke a Calibration '''